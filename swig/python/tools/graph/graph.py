@@ -23,70 +23,279 @@
 #
 from casadi import SX, MX, print_operator
 import casadi as C
-
-try:
-  from pydot import pydot
-except:
-  try:
-    import pydot
-  except:
-    raise Exception("To use the functionality of casadi.tools.graph, you need to have pydot Installed. Try `easy_install pydot`.")
+from collections import deque, defaultdict, OrderedDict
+import numpy as np
+import re
+import subprocess
 
 #import ipdb
 
-def hashcompare(self,other):
-  return cmp(hash(self),hash(other))
-
-
-def equality(self,other):
-  return hash(self)==hash(other)
-
 def getDeps(s):
   deps = []
   if not(hasattr(s,'n_dep')): return deps
   for k in range(s.n_dep()):
-    d = s.dep(k)
-    d.__class__.__cmp__ = hashcompare
-    d.__class__.__eq__  = equality
-    deps.append(d)
+    deps.append(s.dep(k))
   return deps
 
-def addDependency(master,slave,dep={},invdep={}):
-  #print master.__hash__() , " => ", slave.__hash__(), "   ", master , " => ", slave
-  if master in dep:
-    dep[master].add(slave)
-  else:
-    dep[master]= set([slave])
-  if slave in invdep:
-    invdep[slave].add(master)
-  else:
-    invdep[slave] = set([master])
+def addDependency(master,slave,dep,invdep):
+  dep[master].add(slave)
+  invdep[slave].add(master)
 
-def addDependencies(master,slaves,dep={},invdep={}):
-  for slave in slaves:
-    addDependency(master,slave,dep = dep,invdep = invdep)
-  for slave in slaves:
-    dependencyGraph(slave,dep = dep,invdep = invdep)
+_strip_bars = re.compile(r"^\(\|(.*)\|\)$",re.S).match
+_strip_dots = re.compile(r"^\(\.(.*)\.\)$",re.S).match
+_strip_parens = re.compile(r"^\((.*)\)$",re.S).match
+
+def operatorLabel(node,args,commutative=False):
+  """
+  Returns print_operator(node,args), without the parentheses that enclose the whole expression.
+  """
+  s = print_operator(node,args)
+  if commutative:
+    m = _strip_dots(s)
+    if m: s = m.group(1)
+    m = _strip_parens(s)
+    if m: s = m.group(1)
+  else:
+    m = _strip_bars(s)
+    if m: s = m.group(1)
+  return s
 
 def is_leaf(s):
   return s.is_leaf()
   #return s.is_scalar(True) and (s.is_constant() or s.is_symbolic())
 
-def dependencyGraph(s,dep = {},invdep = {}):
+def directDeps(s):
   if isinstance(s,SX):
     if s.is_scalar(True):
-      if not(is_leaf(s)):
-        addDependencies(s,getDeps(s),dep = dep,invdep = invdep)
+      if is_leaf(s):
+        return []
+      return getDeps(s)
     else:
-      addDependencies(s,s.nonzeros(),dep = dep,invdep = invdep)
+      return s.nonzeros()
   elif isinstance(s,MX):
-    addDependencies(s,getDeps(s),dep = dep,invdep = invdep)
-  return (dep,invdep)
+    return getDeps(s)
+  return []
+
+def dependencyGraph(s,dep = None,invdep = None):
+  """
+  Walks the expression graph of s, visiting each node only once.
+
+  Nodes are identified by their hash, since each call to dep(k) returns a new wrapper object.
+  Returns (dep,invdep,nodes): dep and invdep map a node hash to a set of node hashes,
+  nodes maps each node hash to the node itself, in the order the nodes were visited.
+  If given, dep and invdep must be defaultdict(set) instances.
+  """
+  if dep is None: dep = defaultdict(set)
+  if invdep is None: invdep = defaultdict(set)
+  nodes = OrderedDict()
+  stack = deque([s])
+  while stack:
+    s = stack.pop()
+    h = hash(s)
+    if h in nodes: continue
+    nodes[h] = s
+    for d in directDeps(s):
+      hd = hash(d)
+      addDependency(h,hd,dep,invdep)
+      if hd not in nodes:
+        stack.append(d)
+  return (dep,invdep,nodes)
+
+# Nonzero index matrices, keyed by sparsity hash; emptied at the end of every dotgraph call
+_nz_cache = {}
+
+def nz_matrix(sp):
+  """
+  Returns a size1 x size2 array with the nonzero index of each entry of sp, -1 for structural zeros.
+  """
+  entries = _nz_cache.setdefault(sp.hash(),[])
+  for cached_sp, M in entries:
+    if cached_sp==sp: return M
+  M = np.full((sp.size1(),sp.size2()),-1,dtype=int)
+  M[np.array(sp.row(),dtype=int),np.array(sp.get_col(),dtype=int)] = np.arange(sp.nnz())
+  entries.append((sp,M))
+  return M
+
+# HTML fragments and colours shared by the table labels
+_TABLE_OPEN = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0">'
+_TABLE_OPEN_COLOR = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" COLOR="%s">'
+_TABLE_CLOSE = "</TABLE>>"
+_TR_OPEN = "<TR>"
+_TR_CLOSE = "</TR>"
+_TD_EMPTY = "<TD>.</TD>"
+_NZ_CELL = "<TD PORT='f%d' BGCOLOR='%s'>%s</TD>"
+_MAPPING_CELL = "<TD PORT='f%d' BGCOLOR='#eeeeff'> %s </TD>"
+_SPARSITY_COL = "#eeeeee"
+_MAPPING_COL = "#333333"
+
+def sparsityTable(nz,cells):
+  """
+  Returns the <TR> rows of an HTML table laid out like nz: cells[k] is placed at nonzero k, '.' at the structural zeros.
+  """
+  # The extra trailing cell is picked up by the -1 entries of nz
+  cells = np.array(list(cells)+[_TD_EMPTY],dtype=object)
+  return "".join(_TR_OPEN + "".join(row) + _TR_CLOSE for row in cells[nz])
+
+_dot_id = re.compile(r"^([a-zA-Z_][a-zA-Z0-9_]*|-?(\.[0-9]+|[0-9]+(\.[0-9]*)?))$")
+_dot_keywords = ("node","edge","graph","digraph","subgraph","strict")
+
+def quote(value):
+  """
+  Quotes an attribute value for the dot language, unless it is a plain identifier or an HTML-like label.
+  """
+  value = str(value)
+  if (_dot_id.match(value) and value.lower() not in _dot_keywords) or (value.startswith("<") and value.endswith(">")):
+    return value
+  return '"%s"' % value.replace('"','\\"').replace("\n","\\n").replace("\r","\\r")
+
+def attributes(attrs):
+  return ", ".join("%s=%s" % (k,quote(v)) for k,v in attrs.items())
+
+# Statements for the plain box nodes that make up most of a graph; the label goes through quote()
+_SCALAR_NODE = '%s [label=%s, shape=rectangle, color="%s"];\n'
+_DENSE_NODE = '%s [label="%d x %d", shape=rectangle, color="%s", style=filled];\n'
+_LEAF_NODE = '%s [label=%s, shape=box, style=%s];\n'
+
+def drawSparsityNode(graph,sp,id,depid,nzlabels=None,col=_SPARSITY_COL):
+  """
+  Draws sparsity pattern sp as node id, fed by depid.
+
+  A dense pattern is just a box with its dimensions; otherwise a table gets a port per nonzero.
+  """
+  nnz = sp.nnz()
+  n2 = sp.size2()
+  if nnz==sp.numel():
+    graph.write(_DENSE_NODE % (id,sp.size1(),n2,col))
+  else:
+    if nzlabels is None:
+      nzlabels = list(map(str,list(range(nnz))))
+    nz = nz_matrix(sp)
+    parts = [_TABLE_OPEN]
+    parts.append("<TR><TD COLSPAN='%d'><font color='#666666'>%s</font></TD></TR>" % (n2, sp.dim()))
+    # The labels are handed out in row-major order
+    rank = np.empty(nnz,dtype=int)
+    rank[nz[nz>=0]] = np.arange(nnz)
+    cells = [_NZ_CELL % (k,col,nzlabels[r]) for k,r in enumerate(rank)]
+    parts.append(sparsityTable(nz,cells))
+    parts.append(_TABLE_CLOSE)
+    graph.node(id,label="".join(parts),shape='plaintext')
+  graph.edge(depid,id)
+
+class DotEmitter:
+  """
+  Writes dot source text directly, one statement per node or edge.
+  """
+  def __init__(self,name='G',graph_type='digraph',**attrs):
+    self.parts = ["%s %s {\n" % (graph_type,name)]
+    for k,v in attrs.items():
+      self.parts.append("%s=%s;\n" % (k,quote(v)))
+
+  def node(self,name,**attrs):
+    self.parts.append("%s [%s];\n" % (name,attributes(attrs)))
+
+  def edge(self,src,dst,**attrs):
+    if attrs:
+      self.parts.append("%s -> %s [%s];\n" % (src,dst,attributes(attrs)))
+    else:
+      self.parts.append("%s -> %s;\n" % (src,dst))
+
+  def begin_cluster(self,name,**attrs):
+    self.parts.append("subgraph cluster_%s {\n" % name)
+    for k,v in attrs.items():
+      self.parts.append("%s=%s;\n" % (k,quote(v)))
+
+  def write(self,text):
+    """
+    Appends ready-made dot statements.
+    """
+    self.parts.append(text)
 
-class DotArtist:
-  sparsitycol = "#eeeeee"
-  def __init__(self,s,dep={},invdep={},graph=None,artists={},**kwargs):
+  def end_cluster(self):
+    self.parts.append("}\n")
+
+  def getvalue(self):
+    return "".join(self.parts) + "}\n"
+
+# Output formats offered as write_<format> methods
+formats = ("canon cmap cmapx cmapx_np dia dot fig gd gd2 gif hpgl imap imap_np ismap jpe jpeg jpg mif mp "
+           "pcl pdf pic plain plain-ext png ps ps2 raw svg svgz vml vmlz vrml vtx wbmp xdot xlib").split()
+
+_GRAPHVIZ_FORMATS = None
+
+def graphvizFormats(prog='dot'):
+  """
+  Output formats supported by the installed Graphviz, as reported by 'dot -T?'.
+
+  The query is made once; if Graphviz cannot be run, the static formats list is used.
+  """
+  global _GRAPHVIZ_FORMATS
+  if _GRAPHVIZ_FORMATS is None:
+    try:
+      out = subprocess.check_output([prog,'-T?'],stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+      # 'dot -T?' lists the formats in its error message
+      out = e.output
+    except OSError:
+      out = None
+    if out is None or b"Use one of:" not in out:
+      _GRAPHVIZ_FORMATS = set(formats)
+    else:
+      listing = out.decode('utf-8','replace').split("Use one of:",1)[1]
+      _GRAPHVIZ_FORMATS = set(f.split(':')[0] for f in listing.split())
+    _GRAPHVIZ_FORMATS.add('raw')
+  return _GRAPHVIZ_FORMATS
+
+class DotGraph:
+  """
+  Dot source of a graph, rendered by calling the Graphviz 'dot' program.
+
+  Offers to_string() and write_<format>(filename) in the way pydot graphs do.
+  """
+  def __init__(self,source):
+    self.source = source
+
+  def to_string(self):
+    return self.source
+
+  def create(self,format='ps',prog='dot'):
+    if format=='raw':
+      return self.source.encode('utf-8')
+    p = subprocess.Popen([prog,'-T'+format],stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    out, err = p.communicate(self.source.encode('utf-8'))
+    if p.returncode!=0:
+      raise Exception("%s failed to render format '%s':\n%s" % (prog,format,err.decode('utf-8','replace')))
+    return out
+
+  def write(self,path,format='raw',prog='dot'):
+    if format=='raw':
+      with open(path,'w') as f:
+        f.write(self.source)
+      return
+    # Let dot write the file itself instead of passing the output through python
+    p = subprocess.Popen([prog,'-T'+format,'-o',path],stdin=subprocess.PIPE,stderr=subprocess.PIPE)
+    out, err = p.communicate(self.source.encode('utf-8'))
+    if p.returncode!=0:
+      raise Exception("%s failed to render format '%s':\n%s" % (prog,format,err.decode('utf-8','replace')))
+
+  def __getattr__(self,name):
+    action, _, format = name.partition('_')
+    if action in ('write','create'):
+      supported = graphvizFormats()
+      if format not in supported: format = format.replace('_','-')
+      if format in supported:
+        return lambda *args, **kwargs: getattr(self,action)(*args,format=format,**kwargs)
+    raise AttributeError(name)
+
+class DotArtist(object):
+  # One artist is made per node, so keep them free of a per-instance __dict__
+  __slots__ = ("s","key","dep","invdep","graph","artists","node_id","nid","kwargs")
+  sparsitycol = _SPARSITY_COL
+  cluster = False # Artists that draw into a subgraph cluster of their own are drawn last
+  def __init__(self,s,key=None,dep={},invdep={},graph=None,artists={},node_id={},**kwargs):
     self.s = s
+    self.key = hash(s) if key is None else key
+    self.node_id = node_id
+    self.nid = node_id[self.key]
     self.dep = dep
     self.invdep = invdep
     self.graph = graph
@@ -96,38 +305,20 @@ class DotArtist:
   def hasPorts(self):
     return False
 
+  def nodeId(self,node):
+    return self.node_id[hash(node)]
+
   def drawSparsity(self,s,id=None,depid=None,graph=None,nzlabels=None):
     if id is None:
-      id = str(s.__hash__())
+      id = self.nodeId(s)
     if depid is None:
-      depid = str(s.dep(0).__hash__())
+      depid = self.nodeId(s.dep(0))
     if graph is None:
       graph = self.graph
-    sp = s.sparsity()
-    deps = getDeps(s)
-    if nzlabels is None:
-      nzlabels = list(map(str,list(range(sp.nnz()))))
-    nzlabelcounter = 0
-    if s.nnz()==s.numel():
-      graph.add_node(pydot.Node(id,label="%d x %d" % (s.size1(),s.size2()),shape='rectangle',color=self.sparsitycol,style="filled"))
-    else:
-      label = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0">'
-      label+="<TR><TD COLSPAN='%d'><font color='#666666'>%s</font></TD></TR>" % (s.size2(), s.dim())
-      for i in range(s.size1()):
-        label+="<TR>"
-        for j in range(s.size2()):
-          k = sp.get_nz(i,j)
-          if k==-1:
-            label+="<TD>.</TD>"
-          else:
-            label+="<TD PORT='f%d' BGCOLOR='%s'>%s</TD>" % (k,self.sparsitycol,nzlabels[nzlabelcounter])
-            nzlabelcounter +=1
-        label+="</TR>"
-      label+="</TABLE>>"
-      graph.add_node(pydot.Node(id,label=label,shape='plaintext'))
-    graph.add_edge(pydot.Edge(depid,id))
+    drawSparsityNode(graph,s.sparsity(),id,depid,nzlabels=nzlabels,col=self.sparsitycol)
 
 class MXSymbolicArtist(DotArtist):
+  __slots__ = ()
   def hasPorts(self):
     return True
 
@@ -135,26 +326,21 @@ class MXSymbolicArtist(DotArtist):
     s = self.s
     graph = self.graph
     sp = s.sparsity()
-    row = sp.row()
+    nnz = sp.nnz()
+    name = s.name()
     col = "#990000"
-    if s.nnz() == s.numel() and s.nnz()==1:
+    if nnz == sp.numel() and nnz==1:
       # The Matrix grid is represented by a html table with 'ports'
-      graph.add_node(pydot.Node(str(self.s.__hash__())+":f0",label=s.name(),shape='rectangle',color=col))
+      graph.write(_SCALAR_NODE % (self.nid,quote(name),col))
     else:
+      nz = nz_matrix(sp)
        # The Matrix grid is represented by a html table with 'ports'
-      label = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" COLOR="%s">' % col
-      label+="<TR><TD COLSPAN='%d'>%s: <font color='#666666'>%s</font></TD></TR>" % (s.size2(),s.name(), s.dim())
-      for i in range(s.size1()):
-        label+="<TR>"
-        for j in range(s.size2()):
-          k = sp.get_nz(i,j)
-          if k==-1:
-            label+="<TD>.</TD>"
-          else:
-            label+="<TD PORT='f%d' BGCOLOR='#eeeeee'> <font color='#666666'>(%d,%d | %d)</font> </TD>" % (k,i,j,k)
-        label+="</TR>"
-      label+="</TABLE>>"
-      graph.add_node(pydot.Node(str(self.s.__hash__()),label=label,shape='plaintext'))
+      parts = [_TABLE_OPEN_COLOR % col]
+      parts.append("<TR><TD COLSPAN='%d'>%s: <font color='#666666'>%s</font></TD></TR>" % (sp.size2(),name, sp.dim()))
+      cells = ["<TD PORT='f%d' BGCOLOR='#eeeeee'> <font color='#666666'>(%d,%d | %d)</font> </TD>" % (k,i,j,k) for k,(i,j) in enumerate(zip(sp.row(),sp.get_col()))]
+      parts.append(sparsityTable(nz,cells))
+      parts.append(_TABLE_CLOSE)
+      graph.node(self.nid,label="".join(parts),shape='plaintext')
 
 # class MXMappingArtist(DotArtist):
 #   def draw(self):
@@ -224,212 +410,210 @@ class MXSymbolicArtist(DotArtist):
 
 
 class MXEvaluationArtist(DotArtist):
+  __slots__ = ()
+  cluster = True
   def draw(self):
     s = self.s
     graph = self.graph
-    sp = s.sparsity()
-    row = sp.row()
-
-
     deps = getDeps(s)
 
     f = s.which_function()
+    n_in = f.n_in()
+    n_out = f.n_out()
 
     for k,d in enumerate(deps):
-      graph.add_edge(pydot.Edge(str(d.__hash__()),"funinput" + str(s.__hash__())+ ":f%d" % k,rankdir="LR"))
+      graph.edge(self.nodeId(d),"funinput" + self.nid+ ":f%d" % k,rankdir="LR")
 
-    graph = pydot.Cluster(str(s.__hash__()), rank='max', label='Function:\n %s' % f.name())
-    self.graph.add_subgraph(graph)
+    graph.begin_cluster(self.nid, rank='max', label='Function:\n %s' % f.name())
 
-    s = (" %d inputs: |" % f.n_in()) + " | ".join("<f%d> %d" % (i,i) for i in range(f.n_in()))
-    graph.add_node(pydot.Node("funinput" + str(self.s.__hash__()),label=s,shape='Mrecord'))
+    s = (" %d inputs: |" % n_in) + " | ".join("<f%d> %d" % (i,i) for i in range(n_in))
+    graph.node("funinput" + self.nid,label=s,shape='Mrecord')
 
-    s = (" %d outputs: |" % f.n_out())+ " | ".join("<f%d> %d" % (i,i) for i in range(f.n_out()))
-    graph.add_node(pydot.Node(str(self.s.__hash__()),label=s,shape='Mrecord'))
+    s = (" %d outputs: |" % n_out)+ " | ".join("<f%d> %d" % (i,i) for i in range(n_out))
+    graph.node(self.nid,label=s,shape='Mrecord')
+    graph.end_cluster()
 
 
 class MXConstantArtist(DotArtist):
+  __slots__ = ()
   def hasPorts(self):
     return True
   def draw(self):
     s = self.s
     graph = self.graph
     sp = s.sparsity()
-    row = sp.row()
+    nnz = sp.nnz()
+    numel = sp.numel()
     M = s.to_DM()
     col = "#009900"
-    if s.nnz() == s.numel() and s.nnz() == 1:
-      graph.add_node(pydot.Node(str(self.s.__hash__())+":f0",label=str(M[0,0]),shape='rectangle',color=col))
+    if nnz == numel and nnz == 1:
+      graph.write(_SCALAR_NODE % (self.nid,quote(M[0,0]),col))
     else:
       # The Matrix grid is represented by a html table with 'ports'
-      label = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" COLOR="%s">' % col
-      label+="<TR><TD COLSPAN='%d'><font color='#666666'>%s</font></TD></TR>" % (s.size2(), s.dim())
-      if not "max_numel" in self.kwargs or s.numel() < self.kwargs["max_numel"]:
-        for i in range(s.size1()):
-          label+="<TR>"
-          for j in range(s.size2()):
-            k = sp.get_nz(i,j)
-            if k==-1:
-              label+="<TD>.</TD>"
-            else:
-              label+="<TD PORT='f%d' BGCOLOR='#eeeeee'> %s </TD>" % (k,M[i,j])
-          label+="</TR>"
-      label+="</TABLE>>"
-      graph.add_node(pydot.Node(str(self.s.__hash__()),label=label,shape='plaintext'))
+      parts = [_TABLE_OPEN_COLOR % col]
+      parts.append("<TR><TD COLSPAN='%d'><font color='#666666'>%s</font></TD></TR>" % (sp.size2(), sp.dim()))
+      if not "max_numel" in self.kwargs or numel < self.kwargs["max_numel"]:
+        nz = nz_matrix(sp)
+        cells = ["<TD PORT='f%d' BGCOLOR='#eeeeee'> %s </TD>" % (k,M[i,j]) for k,(i,j) in enumerate(zip(sp.row(),sp.get_col()))]
+        parts.append(sparsityTable(nz,cells))
+      parts.append(_TABLE_CLOSE)
+      graph.node(self.nid,label="".join(parts),shape='plaintext')
 
 class MXGenericArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     k = self.s
     graph = self.graph
     dep = getDeps(k)
 
-    show_sp = not(all([d.sparsity()==k.sparsity() for d in dep]))
+    sp = k.sparsity()
+    show_sp = not(all(d.sparsity()==sp for d in dep))
 
     if show_sp:
       op = "op"
-      self.drawSparsity(k,depid=op + str(k.__hash__()))
+      self.drawSparsity(k,depid=op + self.nid)
     else:
       op = ""
 
     if len(dep)>1:
       # Non-commutative operators are represented by 'record' shapes.
       # The dependencies have different 'ports' where arrows should arrive.
-      s = print_operator(self.s,["| <f%d> | " %i for i in range(len(dep))])
-      if s.startswith("(|") and s.endswith("|)"):
-        s=s[2:-2]
+      s = operatorLabel(k,["| <f%d> | " %i for i in range(len(dep))])
 
-      graph.add_node(pydot.Node(op + str(k.__hash__()),label=s,shape='Mrecord'))
+      graph.node(op + self.nid,label=s,shape='Mrecord')
       for i,n in enumerate(dep):
-        graph.add_edge(pydot.Edge(str(n.__hash__()),op + str(k.__hash__())+":f%d" % i))
+        graph.edge(self.nodeId(n),op + self.nid+":f%d" % i)
     else:
       s = print_operator(k,["."])
-      self.graph.add_node(pydot.Node(op + str(k.__hash__()),label=s,shape='oval'))
+      self.graph.node(op + self.nid,label=s,shape='oval')
       for i,n in enumerate(dep):
-        self.graph.add_edge(pydot.Edge(str(n.__hash__()),op + str(k.__hash__())))
+        self.graph.edge(self.nodeId(n),op + self.nid)
 
 class MXGetNonzerosArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     s = self.s
     graph = self.graph
     n = getDeps(s)[0]
 
-
-    show_sp = not(s.nnz() == s.numel() and s.nnz() == 1)
+    sp = s.sparsity()
+    nnz = sp.nnz()
+    scalar = nnz == sp.numel() and nnz == 1
+    show_sp = not(scalar)
 
     if show_sp:
       op = "op"
-      self.drawSparsity(s,depid=op + str(s.__hash__()))
+      self.drawSparsity(s,depid=op + self.nid)
     else:
       op = ""
 
-    sp = s.sparsity()
-    row = sp.row()
-    M = s.mapping()
-    col = "#333333"
-    if s.nnz() == s.numel() and s.nnz() == 1:
-      graph.add_node(pydot.Node(op+str(s.__hash__())+":f0",label="[%s]" % str(M[0,0]),shape='rectangle',style="filled",fillcolor='#eeeeff'))
+    # Source nonzero of each nonzero of s, in nonzero order
+    mapping = np.array(s.mapping().nonzeros(),dtype=int)
+    col = _MAPPING_COL
+    if scalar:
+      graph.node(op+self.nid,label="[%s]" % mapping[0],shape='rectangle',style="filled",fillcolor='#eeeeff')
     else:
       # The Matrix grid is represented by a html table with 'ports'
-      label = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" COLOR="%s">' % col
-      label+="<TR><TD COLSPAN='%d' PORT='entry'>getNonzeros</TD></TR>" % (s.size2())
-      if not "max_nnz" in self.kwargs or s.nnz() < self.kwargs["max_nnz"]:
-        for i in range(s.size1()):
-          label+="<TR>"
-          for j in range(s.size2()):
-            k = sp.get_nz(i,j)
-            if k==-1:
-              label+="<TD>.</TD>"
-            else:
-              label+="<TD PORT='f%d' BGCOLOR='#eeeeff'> %s </TD>" % (k,M[i,j])
-          label+="</TR>"
-      label+="</TABLE>>"
-      graph.add_node(pydot.Node(op+str(s.__hash__()),label=label,shape='plaintext'))
-    self.graph.add_edge(pydot.Edge(str(n.__hash__()),op+str(s.__hash__())))
+      parts = [_TABLE_OPEN_COLOR % col]
+      parts.append("<TR><TD COLSPAN='%d' PORT='entry'>getNonzeros</TD></TR>" % (sp.size2()))
+      if not "max_nnz" in self.kwargs or nnz < self.kwargs["max_nnz"]:
+        nz = nz_matrix(sp)
+        cells = [_MAPPING_CELL % (k,m) for k,m in enumerate(mapping)]
+        parts.append(sparsityTable(nz,cells))
+      parts.append(_TABLE_CLOSE)
+      graph.node(op+self.nid,label="".join(parts),shape='plaintext')
+    self.graph.edge(self.nodeId(n),op+self.nid)
 
 class MXSetNonzerosArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     s = self.s
     graph = self.graph
-    entry = getDeps(s)[0]
-    target = getDeps(s)[1]
-
+    deps = getDeps(s)
+    entry, target = deps[0], deps[1]
 
-    show_sp = not(all([d.sparsity()==s.sparsity() for d in getDeps(s)]))
+    sp = s.sparsity()
+    show_sp = not(all(d.sparsity()==sp for d in deps))
 
     if show_sp:
       op = "op"
-      self.drawSparsity(s,depid=op + str(s.__hash__()))
+      self.drawSparsity(s,depid=op + self.nid)
     else:
       op = ""
 
-    sp = target.sparsity()
-    row = sp.row()
-    M = list(s.mapping())
+    nz = nz_matrix(entry.sparsity())
+    M = np.array(s.mapping().nonzeros(),dtype=int)
     Mk = 0
-    col = "#333333"
+    col = _MAPPING_COL
 
     # The Matrix grid is represented by a html table with 'ports'
-    label = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" COLOR="%s">' % col
-    label+="<TR><TD COLSPAN='%d' PORT='entry'>setNonzeros</TD></TR>" % (s.size2())
-    for i in range(s.size1()):
-      label+="<TR>"
-      for j in range(s.size2()):
-        k = entry.sparsity().get_nz(i,j)
-        if k==-1 or Mk>= len(M) or k != M[Mk]:
-          label+="<TD>.</TD>"
-          if Mk< len(M)-1 and M[Mk]==-1 and k!=-1: Mk+=1
+    parts = [_TABLE_OPEN_COLOR % col]
+    n1, n2 = sp.size1(), sp.size2()
+    nM = len(M)
+    parts.append("<TR><TD COLSPAN='%d' PORT='entry'>setNonzeros</TD></TR>" % (n2))
+    for i in range(n1):
+      parts.append(_TR_OPEN)
+      for j in range(n2):
+        k = nz[i,j]
+        if k==-1 or Mk>= nM or k != M[Mk]:
+          parts.append(_TD_EMPTY)
+          if Mk< nM-1 and M[Mk]==-1 and k!=-1: Mk+=1
         else:
-          label+="<TD PORT='f%d' BGCOLOR='#eeeeff'> %s </TD>" % (Mk,Mk)
+          parts.append(_MAPPING_CELL % (Mk,Mk))
           Mk+=1
-      label+="</TR>"
-    label+="</TABLE>>"
-    graph.add_node(pydot.Node(op+str(s.__hash__()),label=label,shape='plaintext'))
-    self.graph.add_edge(pydot.Edge(str(entry.__hash__()),op+str(s.__hash__())+':entry'))
-    self.graph.add_edge(pydot.Edge(str(target.__hash__()),op+str(s.__hash__())))
+      parts.append(_TR_CLOSE)
+    parts.append(_TABLE_CLOSE)
+    graph.node(op+self.nid,label="".join(parts),shape='plaintext')
+    self.graph.edge(self.nodeId(entry),op+self.nid+':entry')
+    self.graph.edge(self.nodeId(target),op+self.nid)
 
 
 class MXAddNonzerosArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     s = self.s
     graph = self.graph
-    entry = getDeps(s)[0]
-    target = getDeps(s)[1]
+    deps = getDeps(s)
+    entry, target = deps[0], deps[1]
 
-    show_sp = not(all([d.sparsity()==s.sparsity() for d in getDeps(s)]))
+    sp = s.sparsity()
+    show_sp = not(all(d.sparsity()==sp for d in deps))
 
     if show_sp:
       op = "op"
-      self.drawSparsity(s,depid=op + str(s.__hash__()))
+      self.drawSparsity(s,depid=op + self.nid)
     else:
       op = ""
 
-    sp = target.sparsity()
-    row = sp.row()
-    M = list(s.mapping())
+    nz = nz_matrix(target.sparsity())
+    M = np.array(s.mapping().nonzeros(),dtype=int)
     Mk = 0
-    col = "#333333"
+    col = _MAPPING_COL
 
     # The Matrix grid is represented by a html table with 'ports'
-    label = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0" COLOR="%s">' % col
-    label+="<TR><TD COLSPAN='%d' PORT='entry'>addNonzeros</TD></TR>" % (s.size2())
-    for i in range(s.size1()):
-      label+="<TR>"
-      for j in range(s.size2()):
-        k = sp.get_nz(i,j)
-        if k==-1 or Mk>= len(M) or k != M[Mk]:
-          label+="<TD>.</TD>"
-          if Mk< len(M)-1 and M[Mk]==-1 and k!=-1: Mk+=1
+    parts = [_TABLE_OPEN_COLOR % col]
+    n1, n2 = sp.size1(), sp.size2()
+    nM = len(M)
+    parts.append("<TR><TD COLSPAN='%d' PORT='entry'>addNonzeros</TD></TR>" % (n2))
+    for i in range(n1):
+      parts.append(_TR_OPEN)
+      for j in range(n2):
+        k = nz[i,j]
+        if k==-1 or Mk>= nM or k != M[Mk]:
+          parts.append(_TD_EMPTY)
+          if Mk< nM-1 and M[Mk]==-1 and k!=-1: Mk+=1
         else:
-          label+="<TD PORT='f%d' BGCOLOR='#eeeeff'> %s </TD>" % (Mk,Mk)
+          parts.append(_MAPPING_CELL % (Mk,Mk))
           Mk+=1
-      label+="</TR>"
-    label+="</TABLE>>"
-    graph.add_node(pydot.Node(op+str(s.__hash__()),label=label,shape='plaintext'))
-    self.graph.add_edge(pydot.Edge(str(entry.__hash__()),op+str(s.__hash__())+':entry'))
-    self.graph.add_edge(pydot.Edge(str(target.__hash__()),op+str(s.__hash__())))
+      parts.append(_TR_CLOSE)
+    parts.append(_TABLE_CLOSE)
+    graph.node(op+self.nid,label="".join(parts),shape='plaintext')
+    self.graph.edge(self.nodeId(entry),op+self.nid+':entry')
+    self.graph.edge(self.nodeId(target),op+self.nid)
 
 
 class MXOperationArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     k = self.s
     graph = self.graph
@@ -437,39 +621,35 @@ class MXOperationArtist(DotArtist):
 
     show_sp = True
 
-    if k.is_unary() and dep[0].sparsity()==k.sparsity():
+    sp = k.sparsity()
+    if k.is_unary() and dep[0].sparsity()==sp:
       show_sp = False
-    if k.is_binary() and dep[0].sparsity()==k.sparsity() and dep[1].sparsity()==k.sparsity():
+    if k.is_binary() and dep[0].sparsity()==sp and dep[1].sparsity()==sp:
       show_sp = False
 
     if show_sp:
       op = "op"
-      self.drawSparsity(k,depid=op + str(k.__hash__()))
+      self.drawSparsity(k,depid=op + self.nid)
     else:
       op = ""
 
     if not(k.is_commutative()):
       # Non-commutative operators are represented by 'record' shapes.
       # The dependencies have different 'ports' where arrows should arrive.
-      s = print_operator(self.s,["| <f0> | ", " | <f1> |"])
-      if s.startswith("(|") and s.endswith("|)"):
-        s=s[2:-2]
+      s = operatorLabel(k,["| <f0> | ", " | <f1> |"])
 
-      graph.add_node(pydot.Node(op + str(k.__hash__()),label=s,shape='Mrecord'))
+      graph.node(op + self.nid,label=s,shape='Mrecord')
       for i,n in enumerate(dep):
-        graph.add_edge(pydot.Edge(str(n.__hash__()),op + str(k.__hash__())+":f%d" % i))
+        graph.edge(self.nodeId(n),op + self.nid+":f%d" % i)
     else:
      # Commutative operators can be represented more compactly as 'oval' shapes.
-      s = print_operator(k,[".", "."])
-      if s.startswith("(.") and s.endswith(".)"):
-        s=s[2:-2]
-      if s.startswith("(") and s.endswith(")"):
-        s=s[1:-1]
-      self.graph.add_node(pydot.Node(op + str(k.__hash__()),label=s,shape='oval'))
+      s = operatorLabel(k,[".", "."],commutative=True)
+      self.graph.node(op + self.nid,label=s,shape='oval')
       for i,n in enumerate(dep):
-        self.graph.add_edge(pydot.Edge(str(n.__hash__()),op + str(k.__hash__())))
+        self.graph.edge(self.nodeId(n),op + self.nid)
 
 class MXIfTestArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     k = self.s
     graph = self.graph
@@ -479,36 +659,40 @@ class MXIfTestArtist(DotArtist):
 
     s = "<f0> ? | <f1> true"
 
-    graph.add_node(pydot.Node(str(k.__hash__()),label=s,shape='Mrecord'))
+    graph.node(self.nid,label=s,shape='Mrecord')
     for i,n in enumerate(dep):
-      graph.add_edge(pydot.Edge(str(n.__hash__()),str(k.__hash__())+":f%d" % i))
+      graph.edge(self.nodeId(n),self.nid+":f%d" % i)
 
 class MXDensificationArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     k = self.s
     graph = self.graph
     dep = getDeps(k)
 
-    self.graph.add_node(pydot.Node(str(k.__hash__()),label="densify(.)",shape='oval'))
-    self.graph.add_edge(pydot.Edge(str(dep[0].__hash__()),str(k.__hash__())))
+    self.graph.node(self.nid,label="densify(.)",shape='oval')
+    self.graph.edge(self.nodeId(dep[0]),self.nid)
 
 class MXNormArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     k = self.s
     graph = self.graph
     dep = getDeps(k)
     s = print_operator(k,[".", "."])
-    self.graph.add_node(pydot.Node(str(k.__hash__()),label=s,shape='oval'))
-    self.graph.add_edge(pydot.Edge(str(dep[0].__hash__()),str(k.__hash__())))
+    self.graph.node(self.nid,label=s,shape='oval')
+    self.graph.edge(self.nodeId(dep[0]),self.nid)
 
 class MXEvaluationOutputArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     k = self.s
 
-    self.drawSparsity(k,depid=str(hash(k.dep(0))) + ":f%d" % k.which_output())
+    drawSparsityNode(self.graph,k.sparsity(),self.nid,self.nodeId(k.dep(0)) + ":f%d" % k.which_output(),col=self.sparsitycol)
 
 
 class MXMultiplicationArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     k = self.s
     graph = self.graph
@@ -518,52 +702,49 @@ class MXMultiplicationArtist(DotArtist):
     # The dependencies have different 'ports' where arrows should arrive.
     s = "mul(| <f0> | , | <f1> | )"
 
-    graph.add_node(pydot.Node(str(k.__hash__()),label=s,shape='Mrecord'))
+    graph.node(self.nid,label=s,shape='Mrecord')
     for i,n in enumerate(dep):
-      graph.add_edge(pydot.Edge(str(n.__hash__()),str(k.__hash__())+":f%d" % i))
+      graph.edge(self.nodeId(n),self.nid+":f%d" % i)
 
 class SXArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     s = self.s
     graph = self.graph
     sp = s.sparsity()
-    row = sp.row()
+    nz = nz_matrix(sp)
 
     # The Matrix grid is represented by a html table with 'ports'
-    label = '<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0">'
-    for i in range(s.size1()):
-      label+="<TR>"
-      for j in range(s.size2()):
-        k = sp.get_nz(i,j)
-        if k==-1:
-          label+="<TD>.</TD>"
-        else:
-          sx = s.nz[k]
-          if self.shouldEmbed(sx):
-            label+="<TD BGCOLOR='#eeeeee'>%s</TD>" % str(sx)
-          else:
-            self.graph.add_edge(pydot.Edge(str(sx.__hash__()),"%s:f%d" % (str(self.s.__hash__()), k)))
-            label+="<TD PORT='f%d' BGCOLOR='#eeeeee'> <font color='#666666'>(%d,%d|%d)</font> </TD>" % (k,i,j,k)
-      label+="</TR>"
-    label+="</TABLE>>"
-    graph.add_node(pydot.Node(str(self.s.__hash__()),label=label,shape='plaintext'))
+    parts = [_TABLE_OPEN]
+    cells = []
+    for k,(i,j,sx) in enumerate(zip(sp.row(),sp.get_col(),s.nonzeros())):
+      if self.shouldEmbed(sx):
+        cells.append("<TD BGCOLOR='%s'>%s</TD>" % (self.sparsitycol,sx))
+      else:
+        self.graph.edge(self.nodeId(sx),"%s:f%d" % (self.nid, k))
+        cells.append("<TD PORT='f%d' BGCOLOR='#eeeeee'> <font color='#666666'>(%d,%d|%d)</font> </TD>" % (k,i,j,k))
+    parts.append(sparsityTable(nz,cells))
+    parts.append(_TABLE_CLOSE)
+    graph.node(self.nid,label="".join(parts),shape='plaintext')
 
   def shouldEmbed(self,sx):
-    return len(self.invdep[sx]) == 1 and sx.is_leaf()
+    return len(self.invdep[hash(sx)]) == 1 and sx.is_leaf()
 
 class SXLeafArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
-    if len(self.invdep[self.s]) == 1:
-      master = list(self.invdep[self.s])[0]
+    if len(self.invdep.get(self.key,())) == 1:
+      master = list(self.invdep[self.key])[0]
       if hasattr(self.artists[master],'shouldEmbed'):
         if self.artists[master].shouldEmbed(self.s):
           return
     style = "solid" # Symbolic nodes are represented box'es
     if self.s.is_constant():
       style = "bold" # Constants are represented by bold box'es
-    self.graph.add_node(pydot.Node(str(self.s.__hash__()),label=str(self.s),shape="box",style=style))
+    self.graph.write(_LEAF_NODE % (self.nid,quote(self.s),style))
 
 class SXNonLeafArtist(DotArtist):
+  __slots__ = ()
   def draw(self):
     k = self.s
     graph = self.graph
@@ -572,68 +753,64 @@ class SXNonLeafArtist(DotArtist):
       # Non-commutative operators are represented by 'record' shapes.
       # The dependencies have different 'ports' where arrows should arrive.
       if len(dep)==2:
-        s = print_operator(self.s,["| <f0> | ", " | <f1> |"])
+        s = operatorLabel(k,["| <f0> | ", " | <f1> |"])
       else:
-        s = print_operator(self.s,["| <f0> | "])
-      if s.startswith("(|") and s.endswith("|)"):
-        s=s[2:-2]
+        s = operatorLabel(k,["| <f0> | "])
 
-      graph.add_node(pydot.Node(str(k.__hash__()),label=s,shape='Mrecord'))
+      graph.node(self.nid,label=s,shape='Mrecord')
       for i,n in enumerate(dep):
-        graph.add_edge(pydot.Edge(str(n.__hash__()),str(k.__hash__())+":f%d" % i))
+        graph.edge(self.nodeId(n),self.nid+":f%d" % i)
     else:
      # Commutative operators can be represented more compactly as 'oval' shapes.
-      s = print_operator(k,[".", "."])
-      if s.startswith("(.") and s.endswith(".)"):
-        s=s[2:-2]
-      if s.startswith("(") and s.endswith(")"):
-        s=s[1:-1]
-      self.graph.add_node(pydot.Node(str(k.__hash__()),label=s,shape='oval'))
+      s = operatorLabel(k,[".", "."],commutative=True)
+      self.graph.node(self.nid,label=s,shape='oval')
       for i,n in enumerate(dep):
-        self.graph.add_edge(pydot.Edge(str(n.__hash__()),str(k.__hash__())))
+        self.graph.edge(self.nodeId(n),self.nid)
+
 
 
+# MX artists that follow from the operation code alone
+mxArtists = {
+  C.OP_PARAMETER:    MXSymbolicArtist,
+  C.OP_CONST:        MXConstantArtist,
+  C.OP_CALL:         MXEvaluationArtist,
+  C.OP_NORMF:        MXNormArtist,
+  C.OP_NORM2:        MXNormArtist,
+  C.OP_NORM1:        MXNormArtist,
+  C.OP_NORMINF:      MXNormArtist,
+  C.OP_GETNONZEROS:  MXGetNonzerosArtist,
+  C.OP_SETNONZEROS:  MXSetNonzerosArtist,
+  C.OP_ADDNONZEROS:  MXAddNonzerosArtist
+}
 
-def createArtist(node,dep={},invdep={},graph=None,artists={},**kwargs):
+def createArtist(node,key=None,dep={},invdep={},graph=None,artists={},node_id={},**kwargs):
   if isinstance(node,SX):
     if node.is_scalar(True):
       if is_leaf(node):
-        return SXLeafArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
+        artist = SXLeafArtist
       else:
-        return SXNonLeafArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
+        artist = SXNonLeafArtist
     else:
-      return SXArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-
-
+      artist = SXArtist
   elif isinstance(node,MX):
-    if node.is_symbolic():
-      return MXSymbolicArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-    elif node.is_binary() or node.is_unary():
-      return MXOperationArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-    elif node.is_constant():
-      return MXConstantArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-    elif node.is_call():
-      return MXEvaluationArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-    elif node.is_output():
-      return MXEvaluationOutputArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-    elif node.is_norm():
-      return MXNormArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-    elif node.is_op(C.OP_GETNONZEROS):
-      return MXGetNonzerosArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-    elif node.is_op(C.OP_SETNONZEROS):
-      return MXSetNonzerosArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-    elif node.is_op(C.OP_ADDNONZEROS):
-      return MXAddNonzerosArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
-    else:
-      return MXGenericArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
+    artist = mxArtists.get(node.op())
+    if artist is None:
+      if node.is_binary() or node.is_unary():
+        artist = MXOperationArtist
+      elif node.is_output():
+        artist = MXEvaluationOutputArtist
+      else:
+        artist = MXGenericArtist
   else:
-    raise Exception("Cannot create artist for %s" % str(type(s)))
+    raise Exception("Cannot create artist for %s" % str(type(node)))
+  return artist(node,key=key,dep=dep,invdep=invdep,graph=graph,artists=artists,node_id=node_id,**kwargs)
 
-def dotgraph(s,direction="BT",**kwargs):
+def dotgraph(s,direction="BT",emit_source=False,**kwargs):
   """
-  Creates and returns a pydot graph structure that represents an SX.
+  Creates and returns a DotGraph that represents an SX.
 
   direction   one of "BT", "LR", "TB", "RL"
+  emit_source also write the dot source to 'source.dot'
   """
 
   try:
@@ -649,31 +826,34 @@ def dotgraph(s,direction="BT",**kwargs):
     SX__hash__backup = SX.__hash__
     SX.__hash__ = getHashSX
 
-    # Get the dependencies and inverse dependencies in a dict
-    dep, invdep = dependencyGraph(s,{},{})
-
-    allnodes = set(dep.keys()).union(set(invdep.keys()))
+    # Get the dependencies and inverse dependencies in a dict,
+    # and all nodes of the graph (keyed by hash) in the order they were encountered
+    dep, invdep, nodes = dependencyGraph(s,defaultdict(set),defaultdict(set))
 
-    #print "a", set(dep.keys()), [i.__hash__() for i in dep.keys()]
-    #print "b", set(invdep.keys()), [i.__hash__() for i in invdep.keys()]
-    #print "allnodes", allnodes, [i.__hash__() for i in allnodes]
+    # Short, stable names for the nodes in the dot source
+    node_id = dict((h,"n%d" % i) for i,h in enumerate(nodes))
 
-    #return None
+    artists = OrderedDict()
 
-    artists = {}
+    emitter = DotEmitter('G', graph_type='digraph',rankdir=direction)
 
-    graph = pydot.Dot('G', graph_type='digraph',rankdir=direction)
+    for h, node in nodes.items():
+      artists[h] = createArtist(node,key=h,dep=dep,invdep=invdep,graph=emitter,artists=artists,node_id=node_id,**kwargs)
 
-    for node in allnodes:
-      artists[node] = createArtist(node,dep=dep,invdep=invdep,graph=graph,artists=artists,**kwargs)
+    # Plain nodes first, then the clusters, each written in one piece
+    drawn = [artist for artist in artists.values() if artist is not None]
+    for artist in drawn:
+      if not artist.cluster: artist.draw()
+    for artist in drawn:
+      if artist.cluster: artist.draw()
 
-    for artist in artists.values():
-      if artist is None: continue
-      artist.draw()
-
-    open('source.dot','w').write(graph.to_string())
+    graph = DotGraph(emitter.getvalue())
+    if emit_source:
+      with open('source.dot','wb',buffering=1<<20) as f:
+        f.write(graph.to_string().encode('utf-8'))
   finally:
     SX.__hash__ = SX__hash__backup
+    _nz_cache.clear()
   return graph
 
 
@@ -681,25 +861,20 @@ def dotsave(s,format='ps',filename="temp",direction="RL",**kwargs):
   """
   Make a drawing of an SX and save it.
 
-  format can be one of:
+  format can be 'raw' (the dot source) or any format of the installed Graphviz, e.g.:
     dot canon cmap cmapx cmapx_np dia dot fig gd gd2 gif hpgl imap imap_np
-    ismap jpe jpeg jpg mif mp pcl pdf pic plain plain-ext png ps ps2 raw
+    ismap jpe jpeg jpg mif mp pcl pdf pic plain plain-ext png ps ps2
     svg svgz vml vmlz vrml vtx wbmp xdot xlib
 
   direction   one of "BT", "LR", "TB", "RL"
 
   """
-  g = dotgraph(s,direction=direction,**kwargs)
-  if hasattr(g,'write_'+format):
-    getattr(g,'write_'+format)(filename)
-  else:
+  supported = graphvizFormats()
+  if format not in supported:
     s = "Unknown format '%s'. Please pick one of the following:\n" % format
-    l = ['dot']
-    for n in dir(g):
-      if n.startswith("write_"):
-        l.append(n[6:])
-    s+= " ".join(l)
+    s+= " ".join(sorted(supported))
     raise Exception(s)
+  dotgraph(s,direction=direction,**kwargs).write(filename,format=format)
 
 def dotdraw(s,direction="RL",**kwargs):
   """
@@ -724,10 +899,9 @@ def dotdraw(s,direction="RL",**kwargs):
     print("Here goes figure %s (dotdraw)" % figure_name)
   else:
     # Matplotlib does not allow to display vector graphics on screen,
-    # so we fall back to png
-    temp="_temp.png"
-    dotgraph(s,direction=direction,**kwargs).write_png(temp)
-    im = imread(temp)
+    # so we fall back to png, read straight from dot's output
+    from io import BytesIO
+    im = imread(BytesIO(dotgraph(s,direction=direction,**kwargs).create(format='png')))
     figure()
     ax = axes([0,0,1,1], frameon=False)
     ax.set_axis_off()